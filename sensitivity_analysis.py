@@ -0,0 +1,227 @@
+import functools
+import datetime as dt
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+import numpy as np
+import scipy as scp
+
+
+# The parameters of the Fourier (gaussian tempered) shift that we treat as uncertain,
+# together with the values used in ToU_Demo--Fourier_Transform:
+#   sigma_divisor: the gaussian width is sigma = 168/(sigma_divisor*abfr)
+#   decay_slope:   the linear decay in lin_weekdistance_effect_distr is 168/abfr - decay_slope*(week_distance-1)
+#   mid_ratio:     mid price / off price
+#   peak_ratio:    peak price / off price
+# Only the price ratios matter, since the thrift distribution is normalized after dividing by the tariff.
+PARAMETERS = ('sigma_divisor', 'decay_slope', 'mid_ratio', 'peak_ratio')
+DEFAULTS = {'sigma_divisor': 4, 'decay_slope': 1, 'mid_ratio': 10/8, 'peak_ratio': 12/8}
+
+
+def week_tariff_masks(off_days, on_days, ondays_off, ondays_mid, ondays_peak):
+    """
+    Same arguments as week_tariff_scheme in the Fourier notebook, without the prices.
+    Returns:
+        a tuple of length 168 arrays (off, mid, peak) indicating which hours of the week
+        are charged at the off, mid and peak price, so that a tariff can be rebuilt for any price ratios
+    """
+    off = np.outer(off_days, np.ones(24)) + np.outer(on_days, ondays_off)
+    mid = np.outer(on_days, ondays_mid)
+    peak = np.outer(on_days, ondays_peak)
+    return (off.flatten(), mid.flatten(), peak.flatten())
+
+
+def sample_parameters(distributions, n_samples, seed=None, decimals=None):
+    """
+    Parameters:
+        distributions: dict from a name in PARAMETERS to either a fixed value
+            or a function (rng, size) -> array of samples, eg
+            {'sigma_divisor': lambda rng, n: rng.uniform(2, 6, n)}
+            Parameters that are left out keep their DEFAULTS value.
+        n_samples: number of parameter sets to draw
+        seed: seed for np.random.default_rng, so the same seed always gives the same ensemble
+        decimals: if given, round the samples to this many decimals
+            (coarser samples repeat more often, so fewer parameter sets need to be shifted)
+    Returns:
+        a dataframe with one row per sample and one column per parameter
+    """
+    unknown = set(distributions) - set(PARAMETERS)
+    if unknown:
+        raise ValueError('Unknown shift parameters: ' + ', '.join(sorted(unknown)))
+
+    rng = np.random.default_rng(seed)
+    samples = pd.DataFrame(index=pd.RangeIndex(n_samples, name='sample'))
+    # draw in the fixed PARAMETERS order so a seed is reproducible
+    # regardless of the order of the distributions dict
+    for name in PARAMETERS:
+        dist = distributions.get(name, DEFAULTS[name])
+        if callable(dist):
+            samples[name] = np.asarray(dist(rng, n_samples), dtype=float)
+        else:
+            samples[name] = float(dist)
+    if decimals is not None:
+        samples = samples.round(decimals)
+    check_parameters(samples)
+    return samples
+
+
+def check_parameters(samples):
+    """
+    Raises a ValueError if any sample has a non-positive gaussian width divisor or price ratio,
+    which would give a negative gaussian width or a zero or negative tariff
+    """
+    for name in ['sigma_divisor', 'mid_ratio', 'peak_ratio']:
+        bad = ~(samples[name] > 0)
+        if bad.any():
+            raise ValueError(name + ' must be positive, got ' + str(samples[name][bad].iloc[0])
+                             + ' in sample ' + str(samples.index[bad][0]))
+
+
+def week_distance(h1, h2):
+    """
+    circle distance
+    """
+    return (84/np.pi)*np.arccos(np.cos(2*np.pi*(h1-h2)/168) )
+
+
+@functools.lru_cache(maxsize=64)
+def week_distance_effect(sigma_divisor, decay_slope):
+    """
+    The gaussian tempered weekdistance effect (the part of the thrift distribution
+    that doesn't depend on the tariff) as an 85 x 335 array:
+    row abfr = |centered_mod(freq)|, column y-h+167.
+    Cached, since it is shared by every sample with the same sigma_divisor and decay_slope.
+    """
+    # the thrift distribution for frequency k only depends on |centered_mod(k)|,
+    # so we only build the 85 distinct ones
+    abfr = np.arange(85)[:, None]
+    fake_abfr = abfr + (abfr == 0)*1e-64
+
+    # both effects only depend on y-h, so compute them once for every offset in (-168,168)
+    # and then look them up for every (h, y) pair
+    offset = np.arange(-167, 168)[None, :]
+
+    # lin_weekdistance_effect_distr: 0 for abfr=0, 1 for abfr=1, linear decay otherwise
+    X = np.where(abfr > 1, 168/fake_abfr - decay_slope*(week_distance(offset, 0) - 1), abfr)
+    lin = (X + np.abs(X))/2
+
+    sigma = 168/(sigma_divisor*fake_abfr)
+    gauss = np.exp(-0.5*np.power(offset/sigma, 2))/(np.sqrt(2*np.pi)*sigma)
+
+    return gauss*lin
+
+
+def shift_operator(sigma_divisor, decay_slope, tariff):
+    """
+    Vectorized version of shifted_basis_gaussian_tempered_matrix from the Fourier notebook,
+    with the gaussian width and linear decay as parameters.
+    tariff: length 168 array
+    Returns:
+        the 168x168 shifted basis matrix; with sigma_divisor=4 and decay_slope=1
+        this matches shifted_basis_gaussian_tempered_matrix(tariff)
+    """
+    hours = np.arange(168)
+    effect = week_distance_effect(sigma_divisor, decay_slope)
+    ThK = 1e-64 + effect[:, hours[None, :] - hours[:, None] + 167]/np.asarray(tariff)
+    ThK /= ThK.sum(axis=2, keepdims=True)
+
+    # ThK is real and the basis vectors for k and 168-k are conjugate,
+    # so only shift the first 85 basis vectors (real and imaginary parts together)
+    basis = np.transpose(scp.fft.ifft(np.eye(168)))[:85]
+    parts = np.stack([basis.real, basis.imag], axis=1)
+    shifted = np.matmul(parts, ThK)
+    half = shifted[:, 0] + 1j*shifted[:, 1]
+    return np.concatenate([half, np.conj(half[83:0:-1])])
+
+
+def shift_weeks(week_matrix, shiftedbasismatrix):
+    """
+    Shifts every row of week_matrix (an n x 168 array of weekly usage) at once;
+    row by row this is np.real(precomputedspectralshift(week, shiftedbasismatrix))
+    """
+    return np.real(np.matmul(scp.fft.fft(week_matrix, axis=1), shiftedbasismatrix))
+
+
+# Each worker process gets the week matrix and tariff masks once, rather than with every task
+_week_matrix = None
+_masks = None
+
+def _init_worker(week_matrix, masks):
+    global _week_matrix, _masks
+    _week_matrix = week_matrix
+    _masks = masks
+
+def _shift_chunk(params):
+    """
+    Shifts the week matrix for each row of params (in PARAMETERS order)
+    and returns the post-shift peaks and daily maxima
+    """
+    (off, mid, peak) = _masks
+    peaks = np.zeros(len(params))
+    daily_maxima = np.zeros((len(params), _week_matrix.shape[0]*7))
+    for i, (sigma_divisor, decay_slope, mid_ratio, peak_ratio) in enumerate(params):
+        tariff = off + mid_ratio*mid + peak_ratio*peak
+        shifted = shift_weeks(_week_matrix,
+                              shift_operator(sigma_divisor, decay_slope, tariff))
+        peaks[i] = shifted.max()
+        daily_maxima[i] = shifted.reshape(-1, 7, 24).max(axis=2).flatten()
+    return (peaks, daily_maxima)
+
+
+def ensemble_shift(week_pivot, masks, samples, quantiles=(0.05, 0.5, 0.95), n_workers=None, chunksize=16):
+    """
+    **(Monte Carlo Sensitivity Analysis)**:
+    Shifts the weekly usage once for every sampled set of shift parameters and
+    summarizes how much the post-shift peak and daily maxima depend on them.
+
+    Parameters:
+        week_pivot: pivot table of weekly usage indexed by (week, isoyear)
+            with the 168 weekhours as columns, eg res_pivot from dmf.pivot_strip_spare
+        masks: (off, mid, peak) tuple from week_tariff_masks
+        samples: dataframe from sample_parameters
+        quantiles: quantiles to report for the confidence bands
+        n_workers: number of worker processes (None uses all cpus, 1 runs in this process)
+        chunksize: number of distinct parameter sets sent to a worker at a time
+
+    Returns:
+        a tuple containing
+            samples with an added `peak` column (the post-shift peak of each sample)
+        and
+            a series of quantiles of the post-shift peak
+        and
+            a dataframe of quantiles of the post-shift daily maximum, indexed by day
+    Each distinct parameter set is only shifted once, so repeated samples are free.
+    """
+    check_parameters(samples)
+    week_matrix = week_pivot.to_numpy()
+    # np.unique sorts the parameter sets, so samples sharing sigma_divisor and decay_slope
+    # end up next to each other (mostly in the same chunk) and reuse week_distance_effect
+    (unique_params, inverse) = np.unique(samples[list(PARAMETERS)].to_numpy(),
+                                         axis=0, return_inverse=True)
+    chunks = [unique_params[i:i + chunksize] for i in range(0, len(unique_params), chunksize)]
+
+    if n_workers == 1:
+        _init_worker(week_matrix, masks)
+        results = [_shift_chunk(chunk) for chunk in chunks]
+    else:
+        with ProcessPoolExecutor(max_workers=n_workers,
+                                 initializer=_init_worker,
+                                 initargs=(week_matrix, masks)) as executor:
+            results = list(executor.map(_shift_chunk, chunks))
+
+    peaks = np.concatenate([r[0] for r in results])[inverse.flatten()]
+    daily_maxima = np.concatenate([r[1] for r in results])[inverse.flatten()]
+
+    labels = ['q' + format(100*q, 'g') for q in quantiles]
+    samples = samples.copy()
+    samples['peak'] = peaks
+
+    peak_bands = pd.Series(np.quantile(peaks, quantiles), index=labels, name='peak')
+
+    days = [dt.datetime.fromisocalendar(int(isoyear), int(week), day)
+            for (week, isoyear) in week_pivot.index for day in range(1, 8)]
+    daily_max_bands = pd.DataFrame(np.quantile(daily_maxima, quantiles, axis=0).T,
+                                   columns=labels,
+                                   index=pd.DatetimeIndex(days, name='timestamp')).sort_index()
+
+    return (samples, peak_bands, daily_max_bands)